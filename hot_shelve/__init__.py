@@ -1,5 +1,12 @@
+from .bulk import Throughput
+from .bulk import bulk_export
+from .bulk import bulk_load
+from .change_feed import ChangeLog
 from .fake_shelve import FakeShelve
 from .flat_shelve import FlatShelve
+from .flat_shelve import migrate
 from .hot_shelve import HotShelve
+from .path_codec import join_key
+from .path_codec import split_key
 
 __version__ = '0.2.0'
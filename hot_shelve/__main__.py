@@ -0,0 +1,48 @@
+"""
+usage:
+    python -m hot_shelve load <db_file> <json_file> [--workers N]
+    python -m hot_shelve export <db_file> <json_file> [--workers N]
+
+e.g.
+    python -m hot_shelve load data/users.db dumps/users.ndjson
+    python -m hot_shelve export data/users.db dumps/users.ndjson -w 4
+"""
+import argparse
+
+from .bulk import bulk_export
+from .bulk import bulk_load
+from .flat_shelve import FlatShelve
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='hot_shelve',
+        description='bulk load/export a FlatShelve database from/to '
+                    'JSON or NDJSON files.',
+    )
+    parser.add_argument('command', choices=('load', 'export'))
+    parser.add_argument('db_file', help="path to the database, ends with "
+                                        "'.db'.")
+    parser.add_argument('json_file', help='path to the NDJSON (or JSON, '
+                                          'load only) file.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes, default to cpu '
+                             'count.')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    
+    db = FlatShelve(args.db_file)
+    try:
+        if args.command == 'load':
+            result = bulk_load(db, args.json_file,
+                               args.workers, args.batch_size)
+        else:
+            result = bulk_export(db, args.json_file,
+                                 args.workers, args.batch_size)
+        print('{}ed {}'.format(args.command, result))
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""
+parallel bulk loader and exporter for JSON/NDJSON datasets.
+
+record format:
+    a record is one top level key and its value. every line of an NDJSON
+    file is a JSON object of one or more records, a '.json' file is a single
+    JSON object of records. the exporter writes one `{key: value}` line per
+    record.
+    record keys are taken literally as top level keys, e.g. `{"a.b": 1}` is
+    loaded as the key 'a.b', not as the path `db['a']['b']` (unlike
+    `db.update`). so an exported file is always loaded back the same.
+
+the expensive parts (json parsing, pickling leaves, or the reverse when
+exporting) run in a process pool. the main process only merges the key map
+and writes pickled bytes to the backing store in sorted batches.
+"""
+import json
+import os
+import pickle
+import time
+import typing as t
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .flat_shelve import FlatShelve
+from .path_codec import escape
+
+
+class T:
+    Key = str
+    FlatKey = str
+    MapEntry = t.Union[dict, tuple]  # see `FlatShelve._key_map`
+    Leaves = t.List[t.Tuple[FlatKey, bytes]]
+    EncodedRecord = t.Tuple[Key, MapEntry, Leaves]
+    DecodingItem = t.Tuple[Key, MapEntry, t.List[bytes]]
+
+
+class Throughput:
+    """ `records` is the number of top level keys loaded or exported, so the
+        numbers of `bulk_load` and `bulk_export` are comparable. """
+    
+    def __init__(self, records: int, seconds: float):
+        self.records = records
+        self.seconds = seconds
+    
+    @property
+    def records_per_second(self) -> float:
+        return self.records / self.seconds if self.seconds else 0.0
+    
+    def __str__(self):
+        return '{} records in {:.2f}s ({:.0f} records/s)'.format(
+            self.records, self.seconds, self.records_per_second
+        )
+
+
+# -----------------------------------------------------------------------------
+
+# noinspection PyProtectedMember
+def bulk_load(db: FlatShelve, file: str,
+              workers: int = None, batch_size=1000) -> Throughput:
+    """
+    args:
+        db: the target database. existing top level keys are overwritten.
+        file: an NDJSON file ('.ndjson', '.jsonl') or a JSON file ('.json').
+            note the JSON file is parsed as a whole, only NDJSON is streamed.
+        workers: number of worker processes. default to cpu count. 1 means no
+            process pool.
+        batch_size: number of lines (records of a .json file) per worker task,
+            and the least number of flat keys per write batch.
+    
+    note: the database is synced after loading.
+    """
+    start = time.perf_counter()
+    protocol = db._flat_db.protocol
+    buffer = {}  # dict[flat_key, bytes]
+    changes = []  # emitted once the buffer is written.
+    records = 0
+    
+    def flush():
+        db._flat_db.set_raw_items(buffer.items())
+        buffer.clear()
+        if changes:
+            db._emit(changes)
+            changes.clear()
+    
+    for count, encoded_records in _imap(
+            _encode_records, _read_chunks(file, batch_size),
+            workers, protocol
+    ):
+        records += count
+        for key, entry, leaves in encoded_records:
+            written = dict(leaves)
+            if key in db._key_map:
+                for k in db._collect_flat_keys(
+                        db._key_map[key], escape(key)
+                ):
+                    buffer.pop(k, None)
+                    if k not in written:
+                        db._flat_db.pop(k, None)
+                        if db._is_watched:
+                            changes.append(('pop', k))
+            db._key_map[key] = entry
+            buffer.update(written)
+            if db._is_watched:
+                changes.extend(('set', k) for k in written)
+        if len(buffer) >= batch_size:
+            flush()
+    flush()
+    
+    db._invalidate_paths()
+    db.sync()
+    return Throughput(records, time.perf_counter() - start)
+
+
+# noinspection PyProtectedMember
+def bulk_export(db: FlatShelve, file: str,
+                workers: int = None, batch_size=1000) -> Throughput:
+    """
+    args:
+        db: the source database.
+        file: the NDJSON file to write.
+        workers: see `bulk_load`.
+        batch_size: number of top level keys per worker task.
+    
+    note: sets and tuples are exported as JSON arrays, non-str keys are
+        converted to str by `json`.
+    """
+    start = time.perf_counter()
+    records = 0
+    
+    def chunks() -> t.Iterator[t.List[T.DecodingItem]]:
+        batch = []
+        for key in db._key_map:
+            entry = db._key_map[key]
+            batch.append((key, entry, [
+                db._flat_db.get_raw(k)
+                for k in db._collect_flat_keys(entry, escape(key))
+            ]))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
+    with open(file, 'w', encoding='utf-8') as f:
+        for count, lines in _imap(_decode_records, chunks(), workers):
+            f.write(lines)
+            records += count
+    
+    return Throughput(records, time.perf_counter() - start)
+
+
+# -----------------------------------------------------------------------------
+# worker side (must be picklable top level functions)
+
+def _encode_records(lines: t.List[str], protocol: t.Optional[int]
+                    ) -> t.Tuple[int, t.List[T.EncodedRecord]]:
+    out = []
+    for line in lines:
+        for key, value in json.loads(line).items():
+            leaves = []
+            entry = _encode_value(escape(key), value, leaves, protocol)
+            out.append((key, entry, leaves))
+    return len(out), out
+
+
+def _encode_value(flat_key: T.FlatKey, value, leaves: T.Leaves,
+                  protocol: t.Optional[int]) -> T.MapEntry:
+    # the same structure as `FlatShelve._set_node` produces.
+    if isinstance(value, dict):
+        if not value:
+            leaves.append((flat_key, pickle.dumps({}, protocol)))
+        return {
+            k: _encode_value(
+                flat_key + '.' + escape(k), v, leaves, protocol
+            ) for k, v in value.items()
+        }
+    leaves.append((flat_key, pickle.dumps(value, protocol)))
+    if isinstance(value, (list, set)):
+        return 1, type(value)
+    else:
+        return 0, None
+
+
+def _decode_records(batch: t.List[T.DecodingItem]) -> t.Tuple[int, str]:
+    lines = []
+    for key, entry, raw_values in batch:
+        value = _decode_value(entry, iter(raw_values))
+        lines.append(json.dumps(
+            {key: value}, ensure_ascii=False, default=_json_default
+        ) + '\n')
+    return len(batch), ''.join(lines)
+
+
+def _decode_value(entry: T.MapEntry, raw_values: t.Iterator[bytes]):
+    # consume `raw_values` in the same order as
+    # `FlatShelve._collect_flat_keys` yields.
+    if type(entry) is tuple:
+        return pickle.loads(next(raw_values))
+    return {k: _decode_value(v, raw_values) for k, v in entry.items()}
+
+
+def _json_default(obj):
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    raise TypeError('not JSON serializable', obj)
+
+
+# -----------------------------------------------------------------------------
+
+def _read_chunks(file: str, size: int) -> t.Iterator[t.List[str]]:
+    if file.endswith('.json'):
+        with open(file, encoding='utf-8') as f:
+            data = json.load(f)
+        chunk = []
+        for k, v in data.items():
+            chunk.append(json.dumps({k: v}))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        return
+    
+    with open(file, encoding='utf-8') as f:
+        chunk = []
+        for line in f:
+            if line.strip():
+                chunk.append(line)
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+
+def _imap(func: t.Callable, chunks: t.Iterable, workers: t.Optional[int],
+          *args) -> t.Iterator:
+    """ like `map(func, chunks)` but in a process pool, results are in order.
+    
+    unlike `ProcessPoolExecutor.map`, chunks are submitted lazily, so the
+    input is streamed instead of being loaded in memory at once.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk in chunks:
+            yield func(chunk, *args)
+        return
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(func, chunk, *args))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,126 @@
+import re
+import shelve
+import typing as t
+
+from .path_codec import split_raw
+
+
+class T:
+    Op = str  # enum['set', 'pop']
+    FlatKey = str  # e.g. 'a.b.c'
+    Pattern = str  # e.g. 'config.**', 'users.*.name'
+    Callback = t.Callable[[Op, FlatKey], t.Any]
+    Change = t.Tuple[int, Op, FlatKey]  # (seq, op, flat_key)
+
+
+def compile_pattern(pattern: T.Pattern) -> t.Pattern:
+    """
+    pattern syntax (segments are separated by '.'):
+        '*': matches exactly one segment, or part of a segment when mixed
+            with other chars (e.g. 'user_*').
+        '**': matches zero or more segments.
+    for example:
+        'config.**' matches 'config', 'config.a', 'config.a.b', ...
+        'users.*.name' matches 'users.bob.name', but not 'users.name'.
+    literal segments are written in the escaped form of flat keys, e.g.
+    'urls.example\\.com.**'.
+    """
+    any_chars = r'(?:[^.\\]|\\.)*'  # chars of one escaped segment.
+    out = []
+    for seg in split_raw(pattern):
+        if seg == '**':
+            out.append(r'(?:\.' + any_chars + ')*')
+        else:
+            out.append(r'\.' + re.escape(seg).replace(r'\*', any_chars))
+    return re.compile(''.join(out))
+
+
+def match_pattern(regex: t.Pattern, flat_key: T.FlatKey) -> bool:
+    # the compiled regex expects every segment to be led by a '.'.
+    return regex.fullmatch('.' + flat_key) is not None
+
+
+class ChangeLog:
+    """ a persistent, sequence-numbered log of flat key changes.
+    
+    each change is stored as `str(seq) -> (op, flat_key)`. the sequence number
+    starts from 1 and never goes back, even after `truncate`. consumers keep
+    the last seq they have seen as a cursor, and call `since(cursor)` to fetch
+    only the changed paths.
+    """
+    _db: shelve.Shelf
+    _file: t.Optional[str]
+    _data: dict
+    _readonly: bool
+    _first_seq: int
+    last_seq: int
+    
+    def __init__(self, file: t.Optional[str], readonly=False,
+                 data: dict = None):
+        """
+        args:
+            file: path to the log file, must end with '.db'. none for an
+                in-memory log (see `FakeShelve`).
+            readonly: open an existing log for tailing, usually from another
+                process. every `since` call reopens the file to see the new
+                changes, so a long-lived tailer can just poll `since(cursor)`.
+                remember the writer side should `sync` first to make the
+                latest changes visible.
+            data: initial data of an in-memory log, which is got from
+                `to_raw_dict`.
+        """
+        assert file is None or file.endswith('.db')
+        self._file = file
+        self._readonly = readonly
+        self._data = {} if data is None else data
+        self._open()
+    
+    def _open(self) -> None:
+        if self._file is None:
+            self._db = shelve.Shelf(self._data)
+        else:
+            self._db = shelve.open(
+                self._file[:-3], flag='r' if self._readonly else 'c'
+            )
+        self._first_seq = self._db.get('#first', 1)
+        self.last_seq = self._db.get('#last', 0)
+    
+    @property
+    def first_seq(self) -> int:
+        """ the oldest seq still kept in the log. """
+        return self._first_seq
+    
+    def append(self, op: T.Op, flat_key: T.FlatKey) -> int:
+        self.last_seq += 1
+        self._db[str(self.last_seq)] = (op, flat_key)
+        self._db['#last'] = self.last_seq
+        return self.last_seq
+    
+    def since(self, seq: int = 0) -> t.Iterator[T.Change]:
+        """ yield changes whose seq is greater than the given `seq`. """
+        if self._readonly:
+            # dbm readers don't see writes made after they are opened.
+            self._db.close()
+            self._open()
+        for i in range(max(seq + 1, self._first_seq), self.last_seq + 1):
+            change = self._db.get(str(i))
+            if change is not None:  # may be truncated by the writer.
+                yield (i, *change)
+    
+    def truncate(self, seq: int) -> None:
+        """ drop changes whose seq is less than or equal to `seq`. """
+        seq = min(seq, self.last_seq)
+        for i in range(self._first_seq, seq + 1):
+            self._db.pop(str(i), None)
+        self._first_seq = max(self._first_seq, seq + 1)
+        self._db['#first'] = self._first_seq
+    
+    def to_raw_dict(self) -> dict:
+        """ a copy of the underlying (pickled) data, used by snapshots. """
+        return dict(self._db.dict)
+    
+    def sync(self) -> None:
+        self._db.sync()
+    
+    def close(self) -> None:
+        self._db.close()
@@ -1,17 +1,233 @@
-class FakeShelve(dict):
-    
-    @property
-    def key_map(self) -> dict:
-        return self
-    
-    def to_dict(self) -> dict:
-        return self
-    
-    def to_internal_dict(self) -> dict:
-        return self
+import os
+import pickle
+import threading
+import typing as t
+from copy import deepcopy
+
+from .change_feed import ChangeLog
+from .flat_shelve import FlatShelve
+
+
+class MemoryMap(dict):
+    """ in-memory replacement of the key map shelf (opened with writeback, so
+        nested nodes are live objects). """
     
     def sync(self) -> None:
         pass
     
     def close(self) -> None:
         pass
+
+
+class MemoryShelf(MemoryMap):
+    """ in-memory replacement of the flat db shelf.
+    
+    mutable values are copied when they are set and get, so that modifying a
+    value outside does not affect the stored one, just like a real shelf
+    (which pickles/unpickles values).
+    """
+    meta: dict
+    
+    def __init__(self, data: dict, meta: dict = None):
+        super().__init__(data)
+        self.meta = {} if meta is None else meta
+    
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        return deepcopy(value) if type(value) in (dict, list, set) else value
+    
+    def __setitem__(self, key, value):
+        if type(value) in (dict, list, set):
+            value = deepcopy(value)
+        super().__setitem__(key, value)
+    
+    # raw access, see also `EncodedShelf`.
+    
+    protocol = None
+    
+    def get_raw(self, key) -> bytes:
+        return pickle.dumps(super().__getitem__(key))
+    
+    def set_raw_items(self, items: t.Iterable[t.Tuple[str, bytes]]):
+        for k, v in items:
+            super().__setitem__(k, pickle.loads(v))
+    
+    def get_meta(self, key: str, default=None):
+        return self.meta.get(key, default)
+    
+    def set_meta(self, key: str, value) -> None:
+        self.meta[key] = value
+
+
+class FakeShelve(FlatShelve):
+    """ an in-memory FlatShelve, no I/O happens on writes.
+    
+    if `file` is given, the whole database is pickled to it as a snapshot, and
+    loaded back on start. snapshots are taken:
+        - on `sync` and `close` (blocking, the durability point like
+          `FlatShelve.sync`).
+        - `snapshot_interval` seconds after the first write since the last
+          snapshot, by a timer thread. so a write is saved within the
+          interval even if no more writes follow. on posix systems, it is
+          written by a forked child process, which sees a copy-on-write view
+          of the memory, so the writes are not blocked. if the previous child
+          is still writing, it is retried after another interval.
+    writes and snapshots hold the same lock, so a snapshot never sees a
+    half-done write.
+    """
+    _flat_db: MemoryShelf
+    _key_map: MemoryMap
+    _snapshot_file: t.Optional[str]
+    _snapshot_interval: t.Optional[float]
+    _lock: threading.RLock
+    _timer: t.Optional[threading.Timer]
+    _child_pid: int = 0
+    
+    def __init__(self, file: str = None, snapshot_interval: float = None,
+                 change_log=False):
+        """
+        args:
+            file: path to the snapshot file. if not given, the data lives
+                only in memory.
+            snapshot_interval: seconds. none means no periodic snapshots.
+            change_log: see `FlatShelve`. the log is kept in memory and saved
+                in snapshots.
+        """
+        if file is not None and not isinstance(file, str):
+            raise TypeError(
+                'FakeShelve is no longer a dict subclass, `file` must be the '
+                'path to the snapshot file (or none). to start with some '
+                'data, use `FakeShelve().update(data)` instead.', file
+            )
+        self._file = file
+        self._snapshot_file = file
+        self._snapshot_interval = snapshot_interval
+        self._lock = threading.RLock()
+        self._timer = None
+        
+        flat_db, key_map, log_data, meta = {}, {}, None, None
+        if file and os.path.exists(file):
+            with open(file, 'rb') as f:
+                flat_db, key_map, log_data, meta = pickle.load(f)
+        self._init_state(
+            MemoryShelf(flat_db, meta),
+            MemoryMap(key_map),
+            ChangeLog(None, data=log_data) if change_log else None,
+        )
+    
+    def to_internal_dict(self) -> dict:
+        # `dict(self._flat_db)` would expose the stored values.
+        return {k: self._flat_db[k] for k in self._flat_db}
+    
+    # -------------------------------------------------------------------------
+    # writes hold the lock, and the first write after a snapshot schedules the
+    # next one.
+    
+    def _set_node(self, *args):
+        with self._lock:
+            super()._set_node(*args)
+            self._schedule_snapshot()
+    
+    def _pop_node(self, *args):
+        with self._lock:
+            out = super()._pop_node(*args)
+            self._schedule_snapshot()
+            return out
+    
+    def apply_delta(self, file: str) -> int:
+        with self._lock:
+            out = super().apply_delta(file)
+            self._schedule_snapshot()
+            return out
+    
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._schedule_snapshot()
+    
+    def _schedule_snapshot(self):
+        if (
+                self._snapshot_file and
+                self._snapshot_interval is not None and
+                self._timer is None
+        ):
+            self._timer = threading.Timer(
+                self._snapshot_interval, self._on_timer
+            )
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            if self._is_closed:
+                return
+            if not self.snapshot():
+                # the previous snapshot is still being written.
+                self._schedule_snapshot()
+    
+    # -------------------------------------------------------------------------
+    
+    def snapshot(self, block=False) -> bool:
+        """
+        args:
+            block: wait for the in-flight snapshot (if any), then write a new
+                one in this process.
+        
+        returns:
+            false if there is no snapshot file, or (non-blocking only) the
+            previous snapshot is still being written, then this one is
+            skipped.
+        """
+        if not self._snapshot_file:
+            return False
+        with self._lock:
+            if block and self._timer is not None:
+                # this snapshot covers the pending one.
+                self._timer.cancel()
+                self._timer = None
+            if self._child_pid:
+                pid, _ = os.waitpid(
+                    self._child_pid, 0 if block else os.WNOHANG
+                )
+                if pid == 0:
+                    return False
+                self._child_pid = 0
+            
+            if block or not hasattr(os, 'fork'):
+                self._write_snapshot()
+                return True
+            
+            pid = os.fork()
+            if pid == 0:  # child process
+                code = 1
+                try:
+                    self._write_snapshot()
+                    code = 0
+                finally:
+                    os._exit(code)  # noqa
+            self._child_pid = pid
+            return True
+    
+    def _write_snapshot(self):
+        temp_file = self._snapshot_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            pickle.dump(
+                (
+                    dict(self._flat_db),
+                    dict(self._key_map),
+                    self._change_log and self._change_log.to_raw_dict(),
+                    self._flat_db.meta,
+                ), f,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(temp_file, self._snapshot_file)
+    
+    def sync(self):
+        self.snapshot(block=True)
+    
+    def close(self):
+        if self._is_closed:
+            return
+        self.snapshot(block=True)
+        super().close()
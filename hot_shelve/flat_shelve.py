@@ -1,19 +1,36 @@
+import os
 import shelve
+import sys
 import typing as t
 
+from .change_feed import ChangeLog
+from .change_feed import compile_pattern
+from .change_feed import match_pattern
+from .path_codec import EncodedShelf
+from .path_codec import escape
+from .path_codec import join_key
+from .path_codec import rsplit_raw
+from .path_codec import split_key
+from .path_codec import unescape
+
 
 class T:
-    Key = str  # e.g. 'a'
-    FlatKey = str  # e.g. 'a.b.c'
+    Key = t.Union[str, int]  # e.g. 'a', 3. top level keys must be str.
+    FlatKey = str  # e.g. 'a.b.c', see `path_codec` for escaping rules.
+    Path = t.Union[FlatKey, t.Tuple[Key, ...]]  # e.g. 'a.b.c', ('a', 'b', 3)
     Value = t.Any
     
     Node = t.Dict[Key, Value]
-    KeyChain = t.List[Key]
-    #   KeyChain should be always sync with the level of Node.
-    #   flat_key = '.'.join(key_chain)
+    #   every node is addressed by its flat key, the root node's is None
+    #   (not '', which is the flat key of an empty string key).
+    #   flat key of `node[key]` = `_join_key(flat key of node, key)`.
+    Prefix = t.Optional[FlatKey]
     
     Mutable = t.Union[dict, list, set]
     Immutable = t.Union[bool, bytes, int, float, str, tuple, None]
+    
+    ResolvedPath = t.Tuple[Node, Key, FlatKey]
+    #   (parent node, current key, flat key)
 
 
 def _is_nested_node(node) -> bool:
@@ -25,11 +42,17 @@ def _is_ending_node(node) -> bool:
     return type(node) is tuple
 
 
+def _join_key(prefix: T.Prefix, key: T.Key) -> T.FlatKey:
+    if prefix is None:
+        return escape(key)
+    return prefix + '.' + escape(key)
+
+
 class FlatShelve:
     _file: str
     _file_map: str
     
-    _flat_db: shelve.Shelf
+    _flat_db: EncodedShelf
     _key_map: dict
     ''' type: dict[str, dict a | tuple b]
             a: the same structure like root dict. (dict[str, dict[...] | tuple])
@@ -42,14 +65,42 @@ class FlatShelve:
                 warning: currently, if you have a class, instance etc., it will
                     be treated as immutable.
     '''
-    
-    def __init__(self, file: str):
+    _path_cache: t.Dict[str, T.ResolvedPath]
+    ''' a bounded cache of `_resolve` results, to avoid re-splitting the
+        dotted key and walking `_key_map` level by level on every access.
+        it holds references to nodes of `_key_map`, so it must be cleared
+        once a nested node is removed or replaced (see `_invalidate_paths`).
+    '''
+    _path_cache_size = 1024
+    _change_log: t.Optional[ChangeLog]
+    _watchers: t.List[t.Tuple[str, t.Pattern, t.Callable]]
+    
+    def __init__(self, file: str, change_log=False):
+        """
+        args:
+            file: path to the database file, must end with '.db'.
+            change_log: if true, every changed flat key is also recorded in a
+                sequence-numbered log file ('<name>.log.db'). see `changes`.
+        """
         assert file.endswith('.db')
         self._file = file
         self._file_map = file[:-3] + '.map.db'
         
-        self._flat_db = shelve.open(self._file[:-3])
-        self._key_map = shelve.open(self._file_map[:-3], writeback=True)  # noqa
+        self._init_state(
+            EncodedShelf(self._file),
+            shelve.open(self._file_map[:-3], writeback=True),  # noqa
+            ChangeLog(file[:-3] + '.log.db') if change_log else None,
+        )
+    
+    def _init_state(self, flat_db, key_map, change_log: t.Optional[ChangeLog]):
+        """ set up the runtime state on the given stores. subclasses with
+            their own stores (e.g. `FakeShelve`) call this instead of
+            `FlatShelve.__init__`. """
+        self._flat_db = flat_db
+        self._key_map = key_map
+        self._path_cache = {}
+        self._change_log = change_log
+        self._watchers = []
         
         # related issue: https://bugs.python.org/issue42935
         from atexit import register
@@ -62,59 +113,55 @@ class FlatShelve:
     # -------------------------------------------------------------------------
     # dict-like behaviors
     
-    def __setitem__(self, key: str, value) -> None:
-        previous_key, current_key = self._rsplit_key(key)
-        node, key_chain = self._locate_node(previous_key)
-        self._set_node(node, key_chain, current_key, value)
+    def __setitem__(self, key: T.Path, value) -> None:
+        node, current_key, flat_key = self._resolve(key)
+        self._set_node(node, current_key, flat_key, value)
     
-    def __getitem__(self, key: str):
-        previous_key, current_key = self._rsplit_key(key)
-        node, key_chain = self._locate_node(previous_key)
-        return self._get_node(node, key_chain, current_key, default=KeyError)
+    def __getitem__(self, key: T.Path):
+        node, current_key, flat_key = self._resolve(key)
+        return self._get_node(node, current_key, flat_key, default=KeyError)
     
     def keys(self):
         return self._node_keys(self._key_map)
     
     def values(self):
-        return self._node_values(self._key_map, [])
+        return self._node_values(self._key_map, None)
     
     def items(self):
-        return self._node_items(self._key_map, [])
+        return self._node_items(self._key_map, None)
     
-    def get(self, key: str, default=None):
-        if key in self._flat_db:
+    def get(self, key: T.Path, default=None):
+        if type(key) is str and key in self._flat_db:
             flat_key = key
             return self._flat_db[flat_key]
         
-        previous_key, current_key = self._rsplit_key(key)
-        node, key_chain = self._locate_node(previous_key)
+        node, current_key, flat_key = self._resolve(key)
         assert _is_nested_node(node)
-        return self._get_node(node, key_chain, current_key, default)
+        return self._get_node(node, current_key, flat_key, default)
     
-    def setdefault(self, key: str, default=None):
-        previous_key, current_key = self._rsplit_key(key)
-        node, key_chain = self._locate_node(previous_key)
+    def setdefault(self, key: T.Path, default=None):
+        node, current_key, flat_key = self._resolve(key)
         assert _is_nested_node(node)
         
         if current_key in node:
-            return self._get_node(node, key_chain, current_key)
+            return self._get_node(node, current_key, flat_key)
         else:
-            self._set_node(node, key_chain, current_key, default)
-            return self._get_node(node, key_chain, current_key)
+            self._set_node(node, current_key, flat_key, default)
+            return self._get_node(node, current_key, flat_key)
     
     # noinspection PyMethodOverriding
     def update(self, other: dict):
         for key, value in other.items():
             self[key] = value
     
-    def pop(self, key: str, default=None):
-        previous_key, current_key = self._rsplit_key(key)
-        node, key_chain = self._locate_node(previous_key)
+    def pop(self, key: T.Path, default=None):
+        node, current_key, flat_key = self._resolve(key)
         assert _is_nested_node(node)
-        return self._pop_node(node, key_chain, current_key, default)
+        return self._pop_node(node, current_key, flat_key, default)
     
     def popitem(self):
         key, _ = self._key_map.popitem()
+        self._invalidate_paths()
         self._key_map[key] = (0, None)
         #   workaround to prevent the key missing in `self.pop` method.
         return key, self.pop(key)
@@ -129,44 +176,46 @@ class FlatShelve:
         return len(self._key_map)
     
     def __str__(self):
-        return str(self._instantiate(self._key_map, []))
-    
-    def __contains__(self, key: str) -> bool:
-        if '.' in key:
-            if key in self._flat_db:
-                return True
-            previous_key, current_key = key.rsplit('.', 1)
-            node, _ = self._locate_node(previous_key)
-            assert _is_nested_node(node)
-            return current_key in node
-        else:
-            return key in self._key_map
+        return str(self._instantiate(self._key_map, None))
+    
+    def __contains__(self, key: T.Path) -> bool:
+        # resolve the key the same way as `__getitem__` does (e.g. unescape
+        # '\\#tag' to '#tag').
+        try:
+            node, current_key, _ = self._resolve(key)
+        except KeyError:
+            return False
+        return _is_nested_node(node) and current_key in node
     
     # -------------------------------------------------------------------------
     # advanced methods (node based operations)
+    # note: `flat_key` is always the flat key of `node[key]`.
     
-    def _set_node(self, node: T.Node, key_chain: T.KeyChain,
-                  key: T.Key, value: T.Value):
-        # print('[D2429]', node, key_chain, key, value)
+    def _set_node(self, node: T.Node, key: T.Key,
+                  flat_key: T.FlatKey, value: T.Value):
+        # print('[D2429]', node, key, flat_key, value)
+        popped_keys = []
+        written_keys = []
         
         if key in node:
-            for flat_key in self._collect_flat_keys(node, key_chain, key):
-                # print('[D1433]', 'found existed flat key, pop it',
-                #       key, flat_key)
-                self._flat_db.pop(flat_key)
+            if _is_nested_node(node[key]):
+                self._invalidate_paths()
+            for k in self._collect_flat_keys(node[key], flat_key):
+                # print('[D1433]', 'found existed flat key, pop it', key, k)
+                self._flat_db.pop(k)
+                popped_keys.append(k)
             node.pop(key)
         
-        def recurse(node: T.Node, key: T.Key, value: T.Value):
+        def recurse(node: T.Node, key: T.Key,
+                    flat_key: T.FlatKey, value: T.Value):
             if isinstance(value, dict):
                 next_node = node[key] = {}
-                key_chain.append(key)  # temporarily sync with `next_node`.
                 if value:
                     for k, v in value.items():
-                        recurse(next_node, k, v)
+                        recurse(next_node, k, _join_key(flat_key, k), v)
                 else:
-                    flat_key = '.'.join(key_chain)
                     self._flat_db[flat_key] = {}
-                key_chain.pop()  # restore sync with `node`.
+                    written_keys.append(flat_key)
             
             else:
                 if self._is_mutable(value):
@@ -176,161 +225,353 @@ class FlatShelve:
                     node[key] = (0, None)
                     #   TODO: no need to store the immutable type in current
                     #       version.
-                flat_key = '.'.join(key_chain + [key])
                 # print('[D5809]', flat_key, value)
                 self._flat_db[flat_key] = value
+                written_keys.append(flat_key)
         
-        recurse(node, key, value)
-    
-    def _get_node(self, node: T.Node, key_chain: T.KeyChain,
-                  key: T.Key, default=None):
-        key_chain = key_chain.copy()
+        recurse(node, key, flat_key, value)
         
+        if self._is_watched:
+            written = set(written_keys)
+            self._emit(
+                [('pop', k) for k in popped_keys if k not in written] +
+                [('set', k) for k in written_keys]
+            )
+    
+    def _get_node(self, node: T.Node, key: T.Key,
+                  flat_key: T.FlatKey, default=None):
         if default is not KeyError and key not in node:
             return default
         
-        parent_node = node
-        parent_key_chain = key_chain
-        node = node[key]
-        key_chain = key_chain + [key]
-        flat_key = '.'.join(key_chain)
-        
-        if _is_nested_node(node):
-            return DictNode(self, node, key_chain, node)
-        elif node[0] == 0:
+        value = node[key]
+        if _is_nested_node(value):
+            return DictNode(self, value, flat_key, value)
+        elif value[0] == 0:
             return self._flat_db[flat_key]
         else:
             real_value = self._flat_db[flat_key]
             return (
-                ListNode(self, parent_node, parent_key_chain, key, real_value)
-                if node[1] is list else
-                SetNode(self, parent_node, parent_key_chain, key, real_value)
+                ListNode(self, node, flat_key, real_value, key)
+                if value[1] is list else
+                SetNode(self, node, flat_key, real_value, key)
             )
     
-    def _pop_node(self, node: T.Node, key_chain: T.KeyChain,
-                  key: T.Key, default=None):
+    def _pop_node(self, node: T.Node, key: T.Key,
+                  flat_key: T.FlatKey, default=None):
         if key not in node:
             return default
-        out = self._instantiate(node[key], key_chain + [key])
-        for flat_key in self._collect_flat_keys(node, key_chain, key):
-            self._flat_db.pop(flat_key)
+        if _is_nested_node(node[key]):
+            self._invalidate_paths()
+        out = self._instantiate(node[key], flat_key)
+        popped_keys = tuple(self._collect_flat_keys(node[key], flat_key))
+        for k in popped_keys:
+            self._flat_db.pop(k)
         node.pop(key)
+        
+        if self._is_watched:
+            self._emit([('pop', k) for k in popped_keys])
         return out
     
     # noinspection PyMethodMayBeStatic
     def _node_keys(self, node: T.Node):
         return node.keys()
     
-    def _node_values(self, node: T.Node, key_chain: T.KeyChain):
+    def _node_values(self, node: T.Node, prefix: T.Prefix):
         for key, value in node.items():
+            flat_key = _join_key(prefix, key)
             if _is_nested_node(value):
-                yield DictNode(self, value, key_chain + [key], value)
+                yield DictNode(self, value, flat_key, value)
             elif value[0] == 0:
-                flat_key = '.'.join(key_chain + [key])
                 yield self._flat_db[flat_key]
             else:
-                flat_key = '.'.join(key_chain + [key])
                 real_value = self._flat_db[flat_key]
                 yield (
-                    ListNode(self, node, key_chain, key, real_value)
+                    ListNode(self, node, flat_key, real_value, key)
                     if value[1] is list else
-                    SetNode(self, node, key_chain, key, real_value)
+                    SetNode(self, node, flat_key, real_value, key)
                 )
     
-    def _node_items(self, node: T.Node, key_chain: T.KeyChain):
-        return zip(node.keys(), self._node_values(node, key_chain))
+    def _node_items(self, node: T.Node, prefix: T.Prefix):
+        return zip(node.keys(), self._node_values(node, prefix))
     
     def _instantiate(self,
                      node: T.Node,
-                     key_chain: T.KeyChain) -> t.Union[dict, t.Any]:
+                     flat_key: T.Prefix) -> t.Union[dict, t.Any]:
         
         if _is_nested_node(node):
             if node:
                 out = {}
                 
-                def recurse(node_s: dict, node_t: dict):
+                def recurse(node_s: dict, node_t: dict, prefix: T.FlatKey):
                     for k, v in node_s.items():
-                        key_chain.append(k)
                         if _is_nested_node(v):
                             next_node_t = node_t[k] = {}
-                            recurse(v, next_node_t)
+                            recurse(v, next_node_t, _join_key(prefix, k))
                         else:
-                            flat_key = '.'.join(key_chain)
-                            node_t[k] = self._flat_db[flat_key]
-                        key_chain.pop()
+                            node_t[k] = self._flat_db[_join_key(prefix, k)]
                 
-                recurse(node, out)
+                recurse(node, out, flat_key)
                 return out
             else:
                 return {}
         
         else:
-            flat_key = '.'.join(key_chain)
             return self._flat_db[flat_key]
     
     def to_dict(self) -> dict:
-        return self._instantiate(self._key_map, [])
+        return self._instantiate(self._key_map, None)
     
     def to_internal_dict(self) -> dict:
         return dict(self._flat_db)
     
     @staticmethod
     def _collect_flat_keys(
-            node: T.Node, key_chain: T.KeyChain, target_key=None
+            node: T.Node, flat_key: T.Prefix
     ) -> t.Iterator[T.FlatKey]:
-        key_chain = key_chain.copy()
-        
-        if target_key is not None:
-            node = node[target_key]
-            key_chain.append(target_key)  # always keep sync with `node`.
-            if _is_ending_node(node):
-                yield '.'.join(key_chain)
-                return
+        if _is_ending_node(node):
+            yield flat_key
+            return
         
-        def recurse(node: dict):
+        def recurse(node: dict, prefix: T.FlatKey):
             for k, v in node.items():
-                key_chain.append(k)
                 if _is_nested_node(v):
-                    yield from recurse(v)
+                    yield from recurse(v, _join_key(prefix, k))
                 else:
-                    yield '.'.join(key_chain)
-                key_chain.pop()
+                    yield _join_key(prefix, k)
         
-        yield from recurse(node)
+        yield from recurse(node, flat_key)
     
     # -------------------------------------------------------------------------
     # frequently used (private) methods
     
-    @staticmethod
-    def _rsplit_key(key: T.Key) -> t.Tuple[T.Key, T.Key]:
-        if '.' in key:
-            return key.rsplit('.', 1)  # noqa
+    def _resolve(self, key: T.Path) -> T.ResolvedPath:
+        """ resolve a dotted key (or a tuple of keys) to its parent node,
+            current key and flat key.
+        
+        the result is cached if the parent node exists.
+        """
+        try:
+            return self._path_cache[key]
+        except KeyError:
+            pass
+        
+        if type(key) is str:
+            previous_key, current_key = rsplit_raw(key)
+            keys = [] if previous_key is None else split_key(previous_key)
+            current_key = unescape(current_key)
         else:
-            return '', key
+            *keys, current_key = key
+        assert keys or type(current_key) is str, (
+            'top level keys must be str', current_key
+        )
+        node = self._locate_node(keys)
+        out = (node, current_key, sys.intern(join_key(*keys, current_key)))
+        if _is_nested_node(node):
+            if len(self._path_cache) >= self._path_cache_size:
+                # drop the oldest one.
+                self._path_cache.pop(next(iter(self._path_cache)))
+            self._path_cache[key] = out
+        return out
     
-    def _locate_node(self, key: T.Key) -> t.Tuple[T.Node, T.KeyChain]:
-        if not key:
-            return self._key_map, []
-        else:
-            key_chain = key.split('.')
+    def _invalidate_paths(self):
+        self._path_cache.clear()
+    
+    def _locate_node(self, keys: t.List[T.Key]) -> T.Node:
         node = self._key_map
-        for key in key_chain:
-            node = node[key]
-        return node, key_chain
+        for k in keys:
+            node = node[k]
+        return node
     
     @staticmethod
     def _is_mutable(value: T.Value) -> bool:
         return isinstance(value, (dict, list, set))
     
+    # -------------------------------------------------------------------------
+    # change feed
+    
+    def watch(self, pattern: str, callback: t.Callable[[str, str], t.Any]):
+        """
+        args:
+            pattern: a dotted key pattern, '*' matches one segment, '**'
+                matches any depth. e.g. 'config.**', 'users.*.name'.
+            callback: called as `callback(op, flat_key)` after the change is
+                written. `op` is either 'set' or 'pop'.
+        """
+        self._watchers.append((pattern, compile_pattern(pattern), callback))
+    
+    def unwatch(self, pattern: str, callback=None):
+        """ remove watchers of the pattern (only the given callback if
+            specified). """
+        self._watchers = [
+            x for x in self._watchers
+            if not (x[0] == pattern and callback in (None, x[2]))
+        ]
+    
+    def changes(self, since: int = 0) -> t.Iterator[t.Tuple[int, str, str]]:
+        """ yield `(seq, op, flat_key)` changes after the `since` cursor.
+        
+        to tail the log from another process, use
+        `ChangeLog('<name>.log.db', readonly=True).since(cursor)` instead.
+        """
+        assert self._change_log is not None, 'change log is not enabled!'
+        return self._change_log.since(since)
+    
+    @property
+    def last_seq(self) -> int:
+        assert self._change_log is not None, 'change log is not enabled!'
+        return self._change_log.last_seq
+    
+    def truncate_changes(self, seq: int) -> None:
+        """ drop changes whose seq is less than or equal to `seq`.
+        
+        call it once all consumers (tailers, delta backups) have passed the
+        `seq`, otherwise the log grows without limit.
+        """
+        assert self._change_log is not None, 'change log is not enabled!'
+        self._change_log.truncate(seq)
+    
+    @property
+    def _is_watched(self) -> bool:
+        return bool(self._watchers) or self._change_log is not None
+    
+    def _emit(self, changes: t.List[t.Tuple[str, T.FlatKey]]):
+        """ record `(op, flat_key)` changes, then notify the watchers.
+        
+        all changes are logged before any callback runs, so a raising callback
+        cannot leave the change log incomplete.
+        """
+        if self._change_log is not None:
+            for op, flat_key in changes:
+                self._change_log.append(op, flat_key)
+        for op, flat_key in changes:
+            for _, regex, callback in self._watchers:
+                if match_pattern(regex, flat_key):
+                    callback(op, flat_key)
+    
+    # -------------------------------------------------------------------------
+    # backup and replication
+    
+    def backup(self, dest: str, since: int = None) -> t.Optional[int]:
+        """
+        args:
+            dest: path to the backup file, must end with '.db'.
+                full backup: `dest` can be opened by `FlatShelve(dest)`
+                    directly, it remembers the token as the replica's
+                    position.
+                delta backup: `dest` is a delta file, apply it to a replica
+                    by `replica.apply_delta(dest)`. deltas must be applied
+                    in order.
+            since: a token returned by the previous `backup` call. if given,
+                only the flat keys and map entries changed after the token
+                are written (requires `change_log=True`).
+        
+        returns:
+            a token (the last seq of the change log) to be passed as `since`
+            next time. none if the change log is not enabled.
+        
+        note: the copy is consistent as long as the database is used by one
+            thread, since `backup` returns before any other write can happen.
+            there is no lock, so if other threads write to the database, they
+            must be paused during the backup.
+        """
+        assert dest.endswith('.db')
+        token = None
+        if self._change_log is not None:
+            token = self._change_log.last_seq
+        
+        if since is None:
+            flat_db = EncodedShelf(dest, flag='n')
+            key_map = shelve.open(dest[:-3] + '.map', flag='n')
+            for k, v in self._flat_db.items():
+                flat_db[k] = v
+            for k, v in self._key_map.items():
+                key_map[k] = v
+            if token is not None:
+                flat_db.set_meta('token', token)
+            flat_db.close()
+            key_map.close()
+            return token
+        
+        assert self._change_log is not None, 'change log is not enabled!'
+        assert since >= self._change_log.first_seq - 1, (
+            'the change log has been truncated after the token', since
+        )
+        flat_keys = {k for _, _, k in self._change_log.since(since)}
+        map_keys = {split_key(k)[0] for k in flat_keys}
+        #   the key map is stored by top level keys.
+        
+        delta = shelve.open(dest[:-3], flag='n')
+        delta['#since'] = since
+        delta['#until'] = token
+        delta['#deleted_flat'] = [k for k in flat_keys
+                                  if k not in self._flat_db]
+        delta['#deleted_map'] = [k for k in map_keys
+                                 if k not in self._key_map]
+        for k in flat_keys:
+            if k in self._flat_db:
+                delta['f:' + k] = self._flat_db[k]
+        for k in map_keys:
+            if k in self._key_map:
+                delta['m:' + k] = self._key_map[k]
+        delta.close()
+        return token
+    
+    def apply_delta(self, file: str) -> int:
+        """ apply a delta file generated by `backup(dest, since=...)`.
+        
+        the delta must start from the token this replica is at, i.e. the one
+        of its full backup or of the last applied delta.
+        
+        returns:
+            the token of the source database after this delta.
+        """
+        assert file.endswith('.db')
+        with shelve.open(file[:-3], flag='r') as delta:
+            token = self._flat_db.get_meta('token')
+            assert delta['#since'] == token, (
+                'the delta does not continue from the replica, a delta is '
+                'skipped or applied out of order', token, delta['#since']
+            )
+            self._invalidate_paths()
+            changes = []
+            for k in delta['#deleted_map']:
+                self._key_map.pop(k, None)
+            for k in delta['#deleted_flat']:
+                if self._flat_db.pop(k, KeyError) is not KeyError:
+                    changes.append(('pop', k))
+            for k, v in delta.items():
+                if k.startswith('m:'):
+                    self._key_map[k[2:]] = v
+                elif k.startswith('f:'):
+                    self._flat_db[k[2:]] = v
+                    changes.append(('set', k[2:]))
+            token = delta['#until']
+        self._flat_db.set_meta('token', token)
+        if self._is_watched:
+            self._emit(changes)
+        return token
+    
     # -------------------------------------------------------------------------
     
     def sync(self):
         self._flat_db.sync()
         self._key_map.sync()  # noqa
+        self._invalidate_paths()
+        #   `sync` drops the writeback cache of `_key_map`, the cached nodes
+        #   are no longer the live ones.
+        if self._change_log is not None:
+            self._change_log.sync()
     
     def clear(self):
+        popped_keys = (
+            tuple(self._collect_flat_keys(self._key_map, None))
+            if self._is_watched else ()
+        )
         self._flat_db.clear()
         self._key_map.clear()
+        self._invalidate_paths()
+        if popped_keys:
+            self._emit([('pop', k) for k in popped_keys])
     
     _is_closed = False
     
@@ -339,21 +580,87 @@ class FlatShelve:
             return
         self._flat_db.close()
         self._key_map.close()  # noqa
+        if self._change_log is not None:
+            self._change_log.close()
         self._is_closed = True
 
 
+def migrate(file: str) -> None:
+    """ migrate a database with legacy flat keys (plain '.'-joined, no prefix
+        encoding) to the current format.
+    
+    the key map is unchanged, flat keys are rebuilt from it, so keys which
+    contain '.' are migrated correctly as well.
+    
+    the legacy flat db is first copied to '<name>.legacy.db', which is removed
+    only after the rewrite succeeds. if the migration is interrupted, just
+    run it again, it resumes from the backup.
+    """
+    assert file.endswith('.db')
+    stem = file[:-3]
+    backup_stem = stem + '.legacy'
+    
+    if not _dbm_files(backup_stem):
+        with shelve.open(stem + '.path') as table:
+            if '#version' in table:
+                return  # already migrated.
+    
+    # 1. back up the legacy flat db. values are stored under 'v:<old key>',
+    #    '#done' marks the backup is complete.
+    backup = shelve.open(backup_stem)
+    if '#done' not in backup:
+        with shelve.open(stem, flag='r') as old_db:
+            for k, v in old_db.items():
+                backup['v:' + k] = v
+        backup['#done'] = True
+        backup.sync()
+    
+    # 2. rewrite the flat db from the backup.
+    shelve.open(stem, flag='n').close()
+    shelve.open(stem + '.path', flag='n').close()
+    key_map = shelve.open(stem + '.map', flag='r')
+    new_db = EncodedShelf(file)
+    
+    def recurse(node: T.Node, keys: t.List[T.Key]):
+        for k, v in node.items():
+            keys.append(k)
+            if _is_nested_node(v) and v:
+                recurse(v, keys)
+            else:
+                new_db[join_key(*keys)] = backup['v:' + '.'.join(keys)]
+            keys.pop()
+    
+    recurse(key_map, [])
+    new_db.close()
+    key_map.close()
+    backup.close()
+    
+    # 3. drop the backup.
+    for f in _dbm_files(backup_stem):
+        os.remove(f)
+
+
+def _dbm_files(stem: str) -> t.List[str]:
+    """ files of a dbm database, the suffixes depend on the dbm backend. """
+    return [
+        stem + x for x in ('', '.db', '.dat', '.dir', '.bak', '.pag')
+        if os.path.isfile(stem + x)
+    ]
+
+
 # -----------------------------------------------------------------------------
 
 class MutableNode:
+    __slots__ = ('_root', '_node', '_flat_key', '_value')
     
     def __init__(self,
                  root: FlatShelve,
                  node: T.Node,
-                 key_chain: T.KeyChain,
+                 flat_key: T.FlatKey,
                  mutable: T.Mutable):
         self._root = root
         self._node = node
-        self._key_chain = key_chain
+        self._flat_key = flat_key
         self._value = mutable
     
     def __bool__(self):
@@ -376,6 +683,7 @@ class DictNode(MutableNode):
     note: in DictNode, `self._value` is same as `self._node`. we prefer to use
         `self._node` to avoid confusion.
     """
+    __slots__ = ()
     
     # (sort methods by alphabetical order.)
     
@@ -384,8 +692,8 @@ class DictNode(MutableNode):
     
     def __getitem__(self, key):
         return self._root._get_node(
-            self._node, self._key_chain,
-            key, default=KeyError
+            self._node, key,
+            _join_key(self._flat_key, key), default=KeyError
         )
     
     def __iter__(self):
@@ -395,29 +703,42 @@ class DictNode(MutableNode):
         return len(self._node)
     
     def __setitem__(self, key, value):
-        self._root._set_node(self._node, self._key_chain, key, value)
+        self._root._set_node(
+            self._node, key, _join_key(self._flat_key, key), value
+        )
     
     def __str__(self):
-        return str(self._root._instantiate(self._node, self._key_chain))
+        return str(self._root._instantiate(self._node, self._flat_key))
     
     def clear(self):
-        self._node.clear()
-        self._root.pop('.'.join(self._key_chain))
+        # pop the whole node first so its flat keys are removed and emitted,
+        # then put an empty one back.
+        node, key, flat_key = self._root._resolve(
+            tuple(split_key(self._flat_key))
+        )
+        self._root._pop_node(node, key, flat_key)
+        self._root._set_node(node, key, flat_key, {})
+        self._node = self._value = node[key]
     
     def get(self, key, default=None):
-        return self._root._get_node(self._node, self._key_chain, key, default)
+        return self._root._get_node(
+            self._node, key, _join_key(self._flat_key, key), default
+        )
     
     def items(self):
-        return self._root._node_items(self._node, self._key_chain)
+        return self._root._node_items(self._node, self._flat_key)
     
     def keys(self):
         return self._root._node_keys(self._node)
     
     def pop(self, key, default=None):
-        return self._root._pop_node(self._node, self._key_chain, key, default)
+        return self._root._pop_node(
+            self._node, key, _join_key(self._flat_key, key), default
+        )
     
     def popitem(self):
         key, _ = self._node.popitem()
+        self._root._invalidate_paths()
         self._node[key] = (0, None)
         return key, self.pop(key)
     
@@ -433,20 +754,21 @@ class DictNode(MutableNode):
             self[k] = v
     
     def values(self):
-        return self._root._node_values(self._node, self._key_chain)
+        return self._root._node_values(self._node, self._flat_key)
 
 
 # noinspection PyProtectedMember
 class ListNode(MutableNode):
+    __slots__ = ('_current_key',)
     _value: list
     
     def __init__(self,
                  root: FlatShelve,
                  parent_node: T.Node,
-                 parent_key_chain: T.KeyChain,
-                 current_key: T.Key,
-                 mutable: T.Mutable):
-        super().__init__(root, parent_node, parent_key_chain, mutable)
+                 flat_key: T.FlatKey,
+                 mutable: T.Mutable,
+                 current_key: T.Key):
+        super().__init__(root, parent_node, flat_key, mutable)
         self._current_key = current_key
     
     def __getitem__(self, item):
@@ -496,22 +818,23 @@ class ListNode(MutableNode):
     
     def _refresh_root(self):
         self._root._set_node(
-            self._node, self._key_chain,
-            self._current_key, self._value
+            self._node, self._current_key,
+            self._flat_key, self._value
         )
 
 
 # noinspection PyProtectedMember
 class SetNode(MutableNode):
+    __slots__ = ('_current_key',)
     _value: set
     
     def __init__(self,
                  root: FlatShelve,
                  parent_node: T.Node,
-                 parent_key_chain: T.KeyChain,
-                 current_key: T.Key,
-                 mutable: T.Mutable):
-        super().__init__(root, parent_node, parent_key_chain, mutable)
+                 flat_key: T.FlatKey,
+                 mutable: T.Mutable,
+                 current_key: T.Key):
+        super().__init__(root, parent_node, flat_key, mutable)
         self._current_key = current_key
     
     def add(self, value):
@@ -578,6 +901,6 @@ class SetNode(MutableNode):
     
     def _refresh_root(self):
         self._root._set_node(
-            self._node, self._key_chain,
-            self._current_key, self._value
+            self._node, self._current_key,
+            self._flat_key, self._value
         )
@@ -0,0 +1,228 @@
+"""
+flat key encoding.
+
+a flat key is made of escaped key segments joined by '.':
+    str segment: '\\' and '.' are escaped by a leading '\\', a leading '#' is
+        escaped as '\\#'. e.g. 'e.g.' -> 'e\\.g\\.'
+    int segment: '#' + str(int). e.g. 3 -> '#3'
+so any str or int key can be a part of the flat key, and `split_key` always
+gives the original keys back.
+
+on disk, a flat key is stored as '<prefix id>.<last segment>', the prefix (all
+segments except the last one) is dictionary-encoded by `EncodedShelf`.
+"""
+import re
+import shelve
+import typing as t
+from collections.abc import MutableMapping
+
+
+class T:
+    Key = t.Union[str, int]
+    FlatKey = str  # e.g. 'a.b.c', 'urls.https://example\\.com'
+    Segment = str  # an escaped key, e.g. 'example\\.com', '#3'
+    DiskKey = str  # e.g. '12.c'
+
+
+_VERSION = 1
+_unescape_pattern = re.compile(r'\\(.)')
+
+
+def escape(key: T.Key) -> T.Segment:
+    if type(key) is str:
+        if '\\' in key or '.' in key:
+            key = key.replace('\\', '\\\\').replace('.', '\\.')
+        if key.startswith('#'):
+            key = '\\' + key
+        return key
+    elif type(key) is int:
+        return '#' + str(key)
+    else:
+        raise TypeError('key segment must be str or int', key)
+
+
+def unescape(seg: T.Segment) -> T.Key:
+    if seg.startswith('#'):
+        try:
+            return int(seg[1:])
+        except ValueError:
+            raise KeyError(
+                seg, "'#' is reserved for int keys, write a str key starting "
+                     "with '#' as '\\#...'"
+            ) from None
+    if '\\' in seg:
+        return _unescape_pattern.sub(r'\1', seg)
+    return seg
+
+
+def join_key(*keys: T.Key) -> T.FlatKey:
+    """ build a flat key from raw keys.
+    
+    e.g. `db[join_key('urls', 'example.com')] = ...`
+    """
+    return '.'.join(map(escape, keys))
+
+
+def split_key(flat_key: T.FlatKey) -> t.List[T.Key]:
+    return [unescape(x) for x in split_raw(flat_key)]
+
+
+def split_raw(flat_key: T.FlatKey) -> t.List[T.Segment]:
+    """ split a flat key into escaped segments. """
+    if '\\' not in flat_key:
+        return flat_key.split('.')
+    out = []
+    start = 0
+    i = 0
+    while i < len(flat_key):
+        c = flat_key[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '.':
+            out.append(flat_key[start:i])
+            start = i + 1
+        i += 1
+    out.append(flat_key[start:])
+    return out
+
+
+def rsplit_raw(
+        flat_key: T.FlatKey
+) -> t.Tuple[t.Optional[T.FlatKey], T.Segment]:
+    """ split a flat key into (prefix, last escaped segment).
+    
+    the prefix is None if the flat key has only one segment. note '' is a
+    valid prefix, e.g. '.a' is the key 'a' under the empty string key.
+    """
+    if '\\' not in flat_key:
+        if '.' in flat_key:
+            return flat_key.rsplit('.', 1)  # noqa
+        return None, flat_key
+    i = len(flat_key)
+    while True:
+        i = flat_key.rfind('.', 0, i)
+        if i == -1:
+            return None, flat_key
+        # the '.' is a separator only if it follows an even number of '\\'.
+        j = i
+        while j > 0 and flat_key[j - 1] == '\\':
+            j -= 1
+        if (i - j) % 2 == 0:
+            return flat_key[:i], flat_key[i + 1:]
+
+
+# -----------------------------------------------------------------------------
+
+class EncodedShelf(MutableMapping):
+    """ a shelf whose keys are flat keys, stored as short disk keys.
+    
+    the prefix table ('<name>.path.db') maps every prefix to a numeric id. ids
+    are never reused, the root prefix (None) is always 0. the table also keeps
+    metadata under '#'-prefixed keys (a prefix never starts with '#', since
+    the '#' of a top level key is escaped), see `get_meta`.
+    """
+    _shelf: shelve.Shelf
+    _table: shelve.Shelf
+    _ids: t.Dict[t.Optional[T.FlatKey], int]
+    _prefixes: t.List[t.Optional[T.FlatKey]]
+    
+    def __init__(self, file: str, flag='c'):
+        """
+        args:
+            file: path to the database file, must end with '.db'.
+        """
+        assert file.endswith('.db')
+        self._shelf = shelve.open(file[:-3], flag=flag)
+        self._table = shelve.open(file[:-3] + '.path', flag=flag)
+        if '#version' not in self._table:
+            assert len(self._shelf) == 0, (
+                'the database uses the legacy flat key format, please run '
+                '`hot_shelve.migrate(file)` first', file
+            )
+            if flag != 'r':
+                self._table['#version'] = _VERSION
+        
+        self._ids = {None: 0}
+        for k, v in self._table.items():
+            if not k.startswith('#'):
+                self._ids[k] = v
+        self._prefixes = [None] * len(self._ids)
+        for k, v in self._ids.items():
+            self._prefixes[v] = k
+    
+    def _encode(self, flat_key: T.FlatKey,
+                create=False) -> t.Optional[T.DiskKey]:
+        prefix, last = rsplit_raw(flat_key)
+        id_ = self._ids.get(prefix)
+        if id_ is None:
+            if not create:
+                return None
+            id_ = self._ids[prefix] = len(self._prefixes)
+            self._prefixes.append(prefix)
+            self._table[prefix] = id_
+        return str(id_) + '.' + last
+    
+    def _decode(self, disk_key: T.DiskKey) -> T.FlatKey:
+        id_, last = disk_key.split('.', 1)
+        prefix = self._prefixes[int(id_)]
+        return last if prefix is None else prefix + '.' + last
+    
+    def __getitem__(self, flat_key: T.FlatKey):
+        disk_key = self._encode(flat_key)
+        if disk_key is None:
+            raise KeyError(flat_key)
+        return self._shelf[disk_key]
+    
+    def __setitem__(self, flat_key: T.FlatKey, value) -> None:
+        self._shelf[self._encode(flat_key, create=True)] = value
+    
+    def __delitem__(self, flat_key: T.FlatKey) -> None:
+        disk_key = self._encode(flat_key)
+        if disk_key is None:
+            raise KeyError(flat_key)
+        del self._shelf[disk_key]
+    
+    def __contains__(self, flat_key) -> bool:
+        disk_key = self._encode(flat_key)
+        return disk_key is not None and disk_key in self._shelf
+    
+    def __iter__(self) -> t.Iterator[T.FlatKey]:
+        return map(self._decode, self._shelf)
+    
+    def __len__(self) -> int:
+        return len(self._shelf)
+    
+    # raw access (values are pickled bytes), used by bulk loader/exporter.
+    
+    @property
+    def protocol(self) -> t.Optional[int]:
+        return self._shelf._protocol  # noqa
+    
+    def get_raw(self, flat_key: T.FlatKey) -> bytes:
+        disk_key = self._encode(flat_key)
+        if disk_key is None:
+            raise KeyError(flat_key)
+        return self._shelf.dict[disk_key.encode(self._shelf.keyencoding)]
+    
+    def set_raw_items(self, items: t.Iterable[t.Tuple[T.FlatKey, bytes]]):
+        """ write pickled values in the order of disk keys. """
+        encoding = self._shelf.keyencoding
+        for disk_key, data in sorted(
+                (self._encode(k, create=True), v) for k, v in items
+        ):
+            self._shelf.dict[disk_key.encode(encoding)] = data
+    
+    def get_meta(self, key: str, default=None):
+        return self._table.get('#' + key, default)
+    
+    def set_meta(self, key: str, value) -> None:
+        self._table['#' + key] = value
+    
+    def sync(self) -> None:
+        self._shelf.sync()
+        self._table.sync()
+    
+    def close(self) -> None:
+        self._shelf.close()
+        self._table.close()
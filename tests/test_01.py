@@ -35,3 +35,330 @@ def test_set_dict_item():
         'b': 1,
     }
     print(db.to_dict())
+
+
+def test_watch():
+    from uuid import uuid1
+    db = FlatShelve(f'test_db/{uuid1()}.db', change_log=True)
+    events = []
+    db.watch('config.**', lambda op, key: events.append((op, key)))
+    db['config'] = {'host': 'localhost', 'ports': [80]}
+    db['name'] = 'Bob'
+    db['config']['ports'].append(443)
+    db.pop('config')
+    print(events, ':l')
+    assert events == [
+        ('set', 'config.host'), ('set', 'config.ports'),
+        ('set', 'config.ports'),
+        ('pop', 'config.host'), ('pop', 'config.ports'),
+    ]
+    assert [x[2] for x in db.changes(since=4)] == [
+        'config.host', 'config.ports'
+    ]
+    db.close()
+
+
+def test_tail_change_log():
+    from uuid import uuid1
+    from hot_shelve import ChangeLog
+    file = f'test_db/{uuid1()}.db'
+    db = FlatShelve(file, change_log=True)
+    db['a'] = 1
+    db.sync()
+    log = ChangeLog(file[:-3] + '.log.db', readonly=True)
+    assert [x[2] for x in log.since(0)] == ['a']
+    db['b'] = 2
+    db.sync()
+    assert [x[2] for x in log.since(1)] == ['b']  # seen without reopening.
+    db.truncate_changes(1)
+    assert [x[0] for x in db.changes(0)] == [2]
+    log.close()
+    db.close()
+
+
+def test_watch_reads_db_in_callback():
+    db = _random_create_db()
+    db['config'] = {'a': 1, 'b': 2}
+    snapshots = []
+    db.watch('config.**', lambda op, key: snapshots.append(db.to_dict()))
+    assert db.pop('config') == {'a': 1, 'b': 2}
+    # callbacks run after the whole change is written.
+    assert snapshots == [{}, {}]
+    assert db.to_dict() == {} and db.to_internal_dict() == {}
+    db.close()
+
+
+def test_watch_callback_error_keeps_log():
+    from uuid import uuid1
+    db = FlatShelve(f'test_db/{uuid1()}.db', change_log=True)
+    
+    def callback(op, key):
+        raise RuntimeError(op, key)
+    
+    db.watch('cfg.a', callback)
+    try:
+        db['cfg'] = {'a': 1, 'b': 2}
+    except RuntimeError:
+        pass
+    # every change is logged before any callback runs.
+    assert list(db.changes()) == [(1, 'set', 'cfg.a'), (2, 'set', 'cfg.b')]
+    db.close()
+
+
+def test_backup():
+    from uuid import uuid1
+    db = FlatShelve(f'test_db/{uuid1()}.db', change_log=True)
+    db['info'] = {'address': 'Tokyo', 'phone_number': ['123-456-7890']}
+    db['name'] = 'Bob'
+    
+    replica_file = f'test_db/{uuid1()}.db'
+    token = db.backup(replica_file)
+    replica = FlatShelve(replica_file)
+    assert replica.to_dict() == db.to_dict()
+    
+    db['info']['phone_number'].append('987-654-3210')
+    db.pop('name')
+    delta_file = f'test_db/{uuid1()}.db'
+    token = db.backup(delta_file, since=token)
+    assert replica.apply_delta(delta_file) == token
+    print(replica.to_dict())
+    assert replica.to_dict() == db.to_dict()
+    
+    # a skipped delta is rejected.
+    db['a'] = 1
+    db.backup(f'test_db/{uuid1()}.db', since=token)
+    db['b'] = 2
+    delta_file = f'test_db/{uuid1()}.db'
+    db.backup(delta_file, since=db.last_seq - 1)
+    try:
+        replica.apply_delta(delta_file)
+    except AssertionError:
+        pass
+    else:
+        raise Exception('the skipped delta is applied')
+    assert 'b' not in replica
+    db.close()
+    replica.close()
+
+
+def test_dict_node_clear():
+    from uuid import uuid1
+    db = FlatShelve(f'test_db/{uuid1()}.db', change_log=True)
+    db['config'] = {'a': 1, 'b': {'c': 2}}
+    replica_file = f'test_db/{uuid1()}.db'
+    token = db.backup(replica_file)
+    replica = FlatShelve(replica_file)
+    
+    events = []
+    db.watch('config.**', lambda op, key: events.append((op, key)))
+    config = db['config']
+    config.clear()
+    assert events == [
+        ('pop', 'config.a'), ('pop', 'config.b.c'), ('set', 'config')
+    ]
+    assert db.to_dict() == {'config': {}}
+    config['d'] = 3  # the node is still usable after `clear`.
+    assert db.to_dict() == {'config': {'d': 3}}
+    
+    delta_file = f'test_db/{uuid1()}.db'
+    db.backup(delta_file, since=token)
+    replica.apply_delta(delta_file)
+    assert replica.to_dict() == db.to_dict()
+    db.close()
+    replica.close()
+
+
+def test_path_cache():
+    db = _random_create_db()
+    db['a'] = {'b': {'c': 1}}
+    assert db['a.b.c'] == 1
+    db['a'] = {'b': {'c': 2}}  # replaces the cached parent node.
+    assert db['a.b.c'] == 2
+    db['a.b.c'] = 3
+    assert db.to_dict() == {'a': {'b': {'c': 3}}}
+    db.sync()  # drops the writeback cache of the key map.
+    db['a.b.d'] = 4
+    assert db.to_dict() == {'a': {'b': {'c': 3, 'd': 4}}}
+    db.close()
+
+
+def test_escaped_keys():
+    from hot_shelve import join_key
+    db = _random_create_db()
+    db['urls'] = {'https://example.com': {'visits': 1}, 'ids': {3: 'three'}}
+    assert db[('urls', 'https://example.com', 'visits')] == 1
+    assert db[join_key('urls', 'https://example.com')]['visits'] == 1
+    assert db[r'urls.https://example\.com.visits'] == 1
+    assert db['urls.ids.#3'] == 'three'
+    assert db['urls']['ids'][3] == 'three'
+    assert db.to_dict() == {
+        'urls': {'https://example.com': {'visits': 1}, 'ids': {3: 'three'}}
+    }
+    print(db.to_internal_dict(), ':l')
+    db.close()
+
+
+def test_hash_prefixed_keys():
+    db = _random_create_db()
+    db[('#tag',)] = 'x'
+    assert db[r'\#tag'] == 'x'
+    assert r'\#tag' in db and ('#tag',) in db
+    assert '#tag' not in db
+    try:
+        db['#tag']
+    except KeyError:
+        pass
+    else:
+        raise AssertionError
+    db.close()
+
+
+def test_empty_string_key():
+    db = _random_create_db()
+    db[('',)] = {'x': 1}
+    db['x'] = 2
+    assert db.to_dict() == {'': {'x': 1}, 'x': 2}
+    assert db['.x'] == 1 and db[('', 'x')] == 1
+    db.sync()
+    assert set(db.to_internal_dict()) == {'.x', 'x'}
+    db.close()
+
+
+def test_migrate():
+    import shelve
+    from uuid import uuid1
+    from hot_shelve import migrate
+    file = f'test_db/{uuid1()}.db'
+    # a legacy database, flat keys are plain '.'-joined key chains.
+    with shelve.open(file[:-3]) as flat_db:
+        flat_db['name'] = 'Bob'
+        flat_db['info.address'] = 'Tokyo'
+    with shelve.open(file[:-3] + '.map') as key_map:
+        key_map['name'] = (0, None)
+        key_map['info'] = {'address': (0, None)}
+    # simulate an interrupted migration: the backup is complete, but the
+    # flat db has been emptied before the rewrite.
+    with shelve.open(file[:-3] + '.legacy') as backup:
+        backup['v:name'] = 'Bob'
+        backup['v:info.address'] = 'Tokyo'
+        backup['#done'] = True
+    shelve.open(file[:-3], flag='n').close()
+    migrate(file)  # resumes from the backup.
+    db = FlatShelve(file)
+    assert db.to_dict() == {'name': 'Bob', 'info': {'address': 'Tokyo'}}
+    db.close()
+    migrate(file)  # no-op on a migrated database.
+
+
+def test_bulk_load_and_export():
+    import json
+    from uuid import uuid1
+    from hot_shelve import bulk_export
+    from hot_shelve import bulk_load
+    data = {
+        f'user_{i}': {'name': f'user {i}', 'tags': ['a', 'b'], 'info': {}}
+        for i in range(100)
+    }
+    src_file = f'test_db/{uuid1()}.ndjson'
+    with open(src_file, 'w') as f:
+        items = list(data.items())
+        for i in range(0, len(items), 2):  # two records per line.
+            f.write(json.dumps(dict(items[i:i + 2])) + '\n')
+    
+    db = _random_create_db()
+    seen = []
+    # callbacks run after the batch is written, so they can read the keys.
+    db.watch('**', lambda op, key: seen.append(db[key]))
+    result = bulk_load(db, src_file, workers=2, batch_size=30)
+    print(result)
+    assert result.records == 100
+    assert len(seen) == 300
+    assert db.to_dict() == data
+    assert db['user_1.name'] == 'user 1'
+    
+    out_file = f'test_db/{uuid1()}.ndjson'
+    result = bulk_export(db, out_file, workers=2, batch_size=30)
+    print(result)
+    assert result.records == 100
+    with open(out_file) as f:
+        assert {k: v for line in f for k, v in json.loads(line).items()} \
+               == data
+    db.close()
+
+
+def test_fake_shelve():
+    from uuid import uuid1
+    from hot_shelve import FakeShelve
+    file = f'test_db/{uuid1()}.pkl'
+    db = FakeShelve(file)
+    db['info'] = {'address': 'Tokyo'}
+    db['info.phone_number'] = ['123-456-7890']
+    db['info']['phone_number'].append('987-654-3210')
+    assert db.to_dict() == {'info': {
+        'address': 'Tokyo', 'phone_number': ['123-456-7890', '987-654-3210']
+    }}
+    db.close()  # writes the snapshot.
+    
+    db = FakeShelve(file)
+    assert db['info.phone_number'].copy() == ['123-456-7890', '987-654-3210']
+    db.close()
+    
+    try:
+        FakeShelve({'a': 1})  # noqa, the legacy dict-like usage.
+    except TypeError:
+        pass
+    else:
+        raise Exception('a dict is accepted as the snapshot file')
+
+
+def test_fake_shelve_change_log():
+    from uuid import uuid1
+    from hot_shelve import FakeShelve
+    file = f'test_db/{uuid1()}.pkl'
+    db = FakeShelve(file, change_log=True)
+    db['a'] = {'b': 1}
+    db['l'] = [1]
+    assert list(db.changes()) == [(1, 'set', 'a.b'), (2, 'set', 'l')]
+    assert db.last_seq == 2
+    delta = db.backup(f'test_db/{uuid1()}.db', since=1)
+    assert delta == 2
+    
+    d = db.to_internal_dict()
+    d['l'].append(99)
+    assert db['l'].copy() == [1]
+    db.close()
+    
+    db = FakeShelve(file, change_log=True)
+    assert db.last_seq == 2
+    db['c'] = 3
+    assert list(db.changes(2)) == [(3, 'set', 'c')]
+    db.close()
+
+
+def test_fake_shelve_periodic_snapshot():
+    import os
+    import time
+    from uuid import uuid1
+    from hot_shelve import FakeShelve
+    file = f'test_db/{uuid1()}.pkl'
+    db = FakeShelve(file, snapshot_interval=0.05)
+    db['a'] = {'b': [1]}  # schedules a snapshot, no more writes follow.
+    for _ in range(100):
+        if os.path.exists(file):
+            break
+        time.sleep(0.02)
+    assert FakeShelve(file).to_dict() == {'a': {'b': [1]}}
+    
+    db['c'] = 2
+    for _ in range(100):
+        if FakeShelve(file).to_dict().get('c') == 2:
+            break
+        time.sleep(0.02)
+    else:
+        raise Exception('the write is not saved by the timer')
+    
+    db['a.b'].append(2)
+    db['c'] = 3
+    db.sync()  # waits for the in-flight child, then takes a fresh snapshot.
+    assert FakeShelve(file).to_dict() == {'a': {'b': [1, 2]}, 'c': 3}
+    db.close()